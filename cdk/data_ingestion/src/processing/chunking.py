@@ -0,0 +1,179 @@
+import os, re, logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
+import numpy as np
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+from langchain_experimental.text_splitter import (
+    SemanticChunker,
+    combine_sentences,
+)
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of sentences sent to the embeddings model per embed_documents call
+EMBEDDING_BATCH_SIZE = 96
+# Number of embedding batches requested concurrently
+EMBEDDING_MAX_WORKERS = 8
+
+# Format of the extracted page text: "text" (plain text) or "markdown" (headings and tables kept)
+EXTRACTION_FORMAT = os.environ.get("EXTRACTION_FORMAT", "text")
+# Splitter used for documents: "recursive" (no embedding calls), "markdown" or "semantic".
+# Defaults to the markdown splitter for markdown extraction, since only it uses the headings
+SPLITTER = os.environ.get("SPLITTER", "markdown" if EXTRACTION_FORMAT == "markdown" else "recursive")
+if (SPLITTER == "markdown") != (EXTRACTION_FORMAT == "markdown"):
+    logger.warning(
+        f"SPLITTER={SPLITTER} with EXTRACTION_FORMAT={EXTRACTION_FORMAT}: "
+        "heading-bounded chunks need both set to markdown"
+    )
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+# Markdown headings that start a new chunk, and the metadata key each is stored under
+MARKDOWN_HEADERS = [("#", "header_1"), ("##", "header_2"), ("###", "header_3")]
+
+
+class BatchedSemanticChunker(SemanticChunker):
+    """
+    Semantic chunker that embeds the sentences of all texts before splitting.
+
+    SemanticChunker embeds the sentences of each text separately while it splits it.
+    This subclass collects the sentences of every text passed to create_documents,
+    embeds the unique ones in concurrent batches and then splits each text using
+    the precomputed embeddings, with the distances between sentences vectorized in NumPy.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_workers: int = EMBEDDING_MAX_WORKERS,
+        **kwargs
+    ):
+        super().__init__(embeddings, **kwargs)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self._sentence_embeddings: Dict[str, List[float]] = {}
+
+    def _combine_sentences(self, single_sentences_list: List[str]) -> List[dict]:
+        _sentences = [
+            {"sentence": x, "index": i} for i, x in enumerate(single_sentences_list)
+        ]
+        return combine_sentences(_sentences, self.buffer_size)
+
+    def _embed_sentences(self, sentences: List[str]) -> None:
+        """
+        Embed the sentences that are not cached yet, in concurrent batches.
+
+        Args:
+        sentences (List[str]): The combined sentences to embed.
+        """
+        # dict.fromkeys removes duplicates while keeping the original order
+        missing = list(dict.fromkeys(s for s in sentences if s not in self._sentence_embeddings))
+        if not missing:
+            return
+
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        logger.info(f"Embedding {len(missing)} sentences in {len(batches)} batches")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch, vectors in zip(batches, executor.map(self.embeddings.embed_documents, batches)):
+                self._sentence_embeddings.update(zip(batch, vectors))
+
+    def _calculate_sentence_distances(self, single_sentences_list: List[str]):
+        sentences = self._combine_sentences(single_sentences_list)
+        self._embed_sentences([x["combined_sentence"] for x in sentences])
+
+        # Cosine distance between each pair of adjacent sentences, computed on the whole matrix at once
+        vectors = np.array([self._sentence_embeddings[x["combined_sentence"]] for x in sentences], dtype=np.float64)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        distances = (1 - (vectors[:-1] * vectors[1:]).sum(axis=1)).tolist()
+
+        for sentence, distance in zip(sentences, distances):
+            sentence["distance_to_next"] = distance
+
+        return distances, sentences
+
+    def create_documents(
+        self,
+        texts: List[str],
+        metadatas: Optional[List[dict]] = None
+    ) -> List[Document]:
+        all_sentences = []
+        for text in texts:
+            single_sentences_list = re.split(self.sentence_split_regex, text)
+            if len(single_sentences_list) > 1:  # Single sentences are returned without embedding
+                all_sentences.extend(
+                    x["combined_sentence"] for x in self._combine_sentences(single_sentences_list)
+                )
+
+        self._embed_sentences(all_sentences)
+        try:
+            return super().create_documents(texts, metadatas)
+        finally:
+            self._sentence_embeddings.clear()
+
+
+class MarkdownChunker:
+    """
+    Chunker for markdown text that splits on headings, then caps the size of each section.
+
+    Each chunk keeps the metadata of its text plus the headings it falls under.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = CHUNK_SIZE,
+        chunk_overlap: int = CHUNK_OVERLAP
+    ):
+        self.header_splitter = MarkdownHeaderTextSplitter(MARKDOWN_HEADERS, strip_headers=False)
+        self.size_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    def create_documents(
+        self,
+        texts: List[str],
+        metadatas: Optional[List[dict]] = None
+    ) -> List[Document]:
+        _metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for text, metadata in zip(texts, _metadatas):
+            for section in self.header_splitter.split_text(text):
+                section.metadata = {**metadata, **section.metadata}
+                documents.extend(self.size_splitter.split_documents([section]))
+        return documents
+
+
+# Any of the splitters returned by get_text_splitter
+DocumentSplitter = Union[RecursiveCharacterTextSplitter, MarkdownChunker, BatchedSemanticChunker]
+
+
+def get_text_splitter(
+    embeddings: Embeddings,
+    splitter: str = SPLITTER
+) -> DocumentSplitter:
+    """
+    Create the text splitter used to chunk documents.
+
+    Args:
+    embeddings (Embeddings): The embeddings instance used by the semantic splitter.
+    splitter (str, optional): "recursive" for fixed-size chunks, "markdown" for heading-bounded chunks or "semantic" for embedding-based chunks. Defaults to SPLITTER.
+
+    Returns:
+    DocumentSplitter: The text splitter.
+    """
+    if splitter == "semantic":
+        return BatchedSemanticChunker(embeddings)
+    if splitter == "markdown":
+        return MarkdownChunker()
+    if splitter != "recursive":
+        logger.warning(f"Unknown splitter {splitter}, using the recursive splitter")
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n\n", "\n", ". ", " ", ""]
+    )
@@ -1,25 +1,171 @@
-import os, tempfile, logging, uuid
-from io import BytesIO
-from typing import List
+import os, re, logging, threading, uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
 import boto3, pymupdf
 
 from langchain_postgres import PGVector
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_aws import BedrockEmbeddings
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain.indexes import SQLRecordManager, index
+from langchain.indexes import SQLRecordManager
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 
-supported_types = [".pdf", ".docx", ".pptx", ".txt", ".xlsx", ".xps", ".mobi", ".cbz"]
+from processing.chunking import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    EXTRACTION_FORMAT,
+    SPLITTER,
+    DocumentSplitter,
+    get_text_splitter,
+)
+from processing.indexing import (
+    HALFVEC_DIMENSIONS,
+    bulk_index,
+    create_etag_table,
+    create_halfvec_index,
+    get_etags,
+    update_etags,
+)
+
+# Tuple so it can be passed straight to str.endswith
+supported_types = (".pdf", ".docx", ".pptx", ".txt", ".xlsx", ".xps", ".mobi", ".cbz")
+
+# pymupdf4llm is only installed in images built with INSTALL_MARKDOWN=1, so check for it at startup
+if EXTRACTION_FORMAT == "markdown":
+    try:
+        import pymupdf4llm
+    except ImportError as e:
+        raise ImportError("EXTRACTION_FORMAT=markdown requires pymupdf4llm, build the image with INSTALL_MARKDOWN=1") from e
+
+# Plain text extraction flags: keep whitespace and skip text outside the page, no other processing
+TEXT_FLAGS = pymupdf.TEXT_PRESERVE_WHITESPACE | pymupdf.TEXT_MEDIABOX_CLIP
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=8)
+def get_s3_client(region_name: Optional[str] = None, endpoint_url: Optional[str] = None):
+    """
+    Return an S3 client for the given region and endpoint, creating it only once.
+    """
+    return boto3.client('s3', region_name=region_name, endpoint_url=endpoint_url)
+
 # Initialize the S3 client
-s3 = boto3.client('s3')
+s3 = get_s3_client()
 
 EMBEDDING_BUCKET_NAME = os.environ["EMBEDDING_BUCKET_NAME"]
 
+# Local directory used to cache embeddings between invocations of a warm container
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "/tmp/emb_cache")
+# Maximum size of the embedding cache, 0 to disable it. /tmp is the 512 MB default ephemeral
+# storage of the function, so the default leaves most of it free for other temporary files
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# Extraction and chunking settings stored with each ETag, so changing them re-chunks unchanged documents
+INGEST_FINGERPRINT = f"{EXTRACTION_FORMAT}|{TEXT_FLAGS}|{SPLITTER}|{CHUNK_SIZE}|{CHUNK_OVERLAP}"
+
+# Upload the extracted text of each page to the embedding bucket for auditing
+PERSIST_PAGES = os.environ.get("PERSIST_PAGES", "0") == "1"
+
+# Number of concurrent S3 requests used when uploading extracted pages
+S3_MAX_WORKERS = 16
+
+
+def get_source(
+    topic: str,
+    filename: str,
+    bucket: str = EMBEDDING_BUCKET_NAME
+) -> str:
+    """
+    Build the source of a document, used as its chunk metadata, record manager group id and ETag key.
+    
+    Args:
+    topic (str): The topic ID folder in the S3 bucket.
+    filename (str): The name of the document file.
+    bucket (str, optional): The name of the S3 bucket the source refers to. Defaults to EMBEDDING_BUCKET_NAME.
+    
+    Returns:
+    str: The source of the document.
+    """
+    return f"s3://{bucket}/{topic}/documents/{filename}"
+
+class BoundedFileStore(LocalFileStore):
+    """
+    LocalFileStore that deletes its least recently used files once their total size exceeds a budget.
+    
+    Files already in the directory, left by previous invocations of a warm container,
+    count towards the budget from the start, ordered by modification time. Reads and
+    writes hold a lock, since the semantic chunker embeds batches from several threads.
+    """
+
+    def __init__(self, root_path: str, max_bytes: int):
+        super().__init__(root_path)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes: "OrderedDict[Path, int]" = OrderedDict()
+        if self.root_path.exists():
+            files = [(path.stat(), path.resolve()) for path in self.root_path.rglob("*") if path.is_file()]
+            for file_stat, path in sorted(files, key=lambda x: x[0].st_mtime):
+                self._sizes[path] = file_stat.st_size
+        self._total = sum(self._sizes.values())
+        self._evict()
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        with self._lock:
+            values = super().mget(keys)
+            for key, value in zip(keys, values):
+                path = self._get_full_path(key)
+                if value is not None and path in self._sizes:
+                    self._sizes.move_to_end(path)
+            return values
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        with self._lock:
+            super().mset(key_value_pairs)
+            for key, value in key_value_pairs:
+                path = self._get_full_path(key)
+                self._total += len(value) - self._sizes.pop(path, 0)
+                self._sizes[path] = len(value)
+            self._evict()
+
+    def _evict(self) -> None:
+        # Called with the lock held, or from __init__ before the store is shared
+        while self._sizes and self._total > self.max_bytes:
+            path, size = self._sizes.popitem(last=False)
+            path.unlink(missing_ok=True)
+            self._total -= size
+
+def get_cached_embeddings(
+    embeddings: BedrockEmbeddings,
+    max_bytes: int = EMBEDDING_CACHE_MAX_BYTES
+) -> Embeddings:
+    """
+    Wrap an embeddings instance with a size-bounded file cache keyed by the hash of each text.
+    
+    Args:
+    embeddings (BedrockEmbeddings): The embeddings instance.
+    max_bytes (int, optional): The maximum size of the cache, 0 to disable it. Defaults to EMBEDDING_CACHE_MAX_BYTES.
+    
+    Returns:
+    Embeddings: The embeddings instance backed by the local cache, or the instance itself if the cache is disabled.
+    """
+    if max_bytes <= 0:
+        return embeddings
+    store = BoundedFileStore(EMBEDDING_CACHE_DIR, max_bytes)
+    # LocalFileStore keys only allow letters, digits and _.-/, so model ids such as
+    # "amazon.titan-embed-text-v2:0" are cleaned and used as a subdirectory
+    namespace = re.sub(r"[^A-Za-z0-9_.\-]", "_", embeddings.model_id) + "/"
+    return CacheBackedEmbeddings.from_bytes_store(
+        embeddings,
+        store,
+        namespace=namespace,
+        key_encoder="sha256"
+    )
 
 def extract_txt(
     bucket: str, 
@@ -35,145 +181,93 @@ def extract_txt(
     Returns:
     str: The extracted text.
     """
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        s3.download_fileobj(bucket, file_key, tmp_file)
-        tmp_file_path = tmp_file.name
-
-    try:
-        with open(tmp_file_path, 'r', encoding='utf-8') as file:
-            text = file.read()
-    finally:
-        os.remove(tmp_file_path)
-
-    return text
+    body = s3.get_object(Bucket=bucket, Key=file_key)['Body'].read()
+    return body.decode('utf-8')
 
 def store_doc_texts(
     bucket: str, 
     topic: str, 
     filename: str, 
-    output_bucket: str
-) -> List[str]:
+    output_bucket: str,
+    persist_pages: bool = PERSIST_PAGES
+) -> List[Tuple[str, str]]:
     """
-    Store the text of each page of a document in an S3 bucket.
+    Extract the text of each page of a document, optionally storing it in an S3 bucket.
     
     Args:
     bucket (str): The name of the S3 bucket containing the document.
     topic (str): The topic ID folder in the S3 bucket.
     filename (str): The name of the document file.
     output_bucket (str): The name of the S3 bucket for storing the extracted text.
+    persist_pages (bool, optional): Whether to upload the text of each page to the output bucket. Defaults to PERSIST_PAGES.
     
     Returns:
-    List[str]: A list of keys for the stored text files in the output bucket.
+    List[Tuple[str, str]]: A list of (page key, page text) pairs, one per page of the document.
     """
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        s3.download_file(bucket, f"{topic}/documents/{filename}", tmp_file.name)
-        file_name, file_type = filename.rsplit('.', 1)  # Split on the last period
-        
-        if file_type not in supported_types:
-            file_type = "txt"
-        doc = pymupdf.open(tmp_file.name, filetype=file_type)
-        
-        with BytesIO() as output_buffer:
-            for page_num, page in enumerate(doc, start=1):
-                text = page.get_text().encode("utf8")
-                output_buffer.write(text)
-                output_buffer.write(bytes((12,)))
-                
-                page_output_key = f'{topic}/documents/{filename}_page_{page_num}.txt'
-                
-                with BytesIO(text) as page_output_buffer:
-                    s3.upload_fileobj(page_output_buffer, output_bucket, page_output_key)
+    # Read the body once; PyMuPDF opens the bytes without another copy through a buffer
+    file_bytes = s3.get_object(Bucket=bucket, Key=f"{topic}/documents/{filename}")['Body'].read()
+    file_name, file_type = filename.rsplit('.', 1)  # Split on the last period
+    
+    if not filename.endswith(supported_types):
+        file_type = "txt"
+    # The document is closed on exit, releasing MuPDF memory as soon as the text is extracted
+    with pymupdf.open(stream=file_bytes, filetype=file_type) as doc:
+        if EXTRACTION_FORMAT == "markdown":
+            page_texts = [chunk["text"] for chunk in pymupdf4llm.to_markdown(doc, page_chunks=True)]
+        else:
+            page_texts = [doc[page_num].get_text("text", flags=TEXT_FLAGS) for page_num in range(doc.page_count)]
 
-        os.remove(tmp_file.name)
+        pages = [
+            (f'{topic}/documents/{filename}_page_{page_num}.txt', page_text)
+            for page_num, page_text in enumerate(page_texts, start=1)
+        ]
 
-    return [f'{topic}/documents/{filename}_page_{page_num}.txt' for page_num in range(1, len(doc) + 1)]
+    if persist_pages:
+        # Upload all pages concurrently; the S3 client is thread-safe
+        with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as executor:
+            list(executor.map(
+                lambda page: s3.put_object(Bucket=output_bucket, Key=page[0], Body=page[1].encode("utf8")),
+                pages
+            ))
 
-def add_document(
-    bucket: str, 
-    topic: str, 
-    filename: str, 
-    vectorstore: PGVector, 
-    embeddings: BedrockEmbeddings,
-    output_bucket: str = EMBEDDING_BUCKET_NAME
-) -> List[Document]:
-    """
-    Add a document to the vectorstore.
-    
-    Args:
-    bucket (str): The name of the S3 bucket containing the document.
-    topic (str): The topic ID folder in the S3 bucket.
-    filename (str): The name of the document file.
-    vectorstore (PGVector): The vectorstore instance.
-    embeddings (BedrockEmbeddings): The embeddings instance.
-    output_bucket (str, optional): The name of the S3 bucket for storing extracted data. Defaults to 'temp-extracted-data'.
-    
-    Returns:
-    List[Document]: A list of all document chunks for this document that were added to the vectorstore.
-    """
-    
-    
-    output_filenames = store_doc_texts(
-        bucket=bucket,
-        topic=topic,
-        filename=filename,
-        output_bucket=output_bucket
-    )
-    
-    this_doc_chunks = store_doc_chunks(
-        bucket=output_bucket,
-        filenames=output_filenames,
-        vectorstore=vectorstore,
-        embeddings=embeddings
-    )
-    
-    return this_doc_chunks
+    return pages
 
 def store_doc_chunks(
-    bucket: str, 
-    filenames: List[str],
+    source: str, 
+    pages: List[Tuple[str, str]],
     vectorstore: PGVector, 
-    embeddings: BedrockEmbeddings
+    embeddings: BedrockEmbeddings,
+    text_splitter: Optional[DocumentSplitter] = None
 ) -> List[Document]:
     """
     Store chunks of documents in the vectorstore.
     
     Args:
-    bucket (str): The name of the S3 bucket containing the text files.
-    filenames (List[str]): A list of keys for the text files in the bucket.
+    source (str): The source of the document, as built by get_source.
+    pages (List[Tuple[str, str]]): A list of (page key, page text) pairs returned by store_doc_texts.
     vectorstore (PGVector): The vectorstore instance.
     embeddings (BedrockEmbeddings): The embeddings instance.
+    text_splitter (DocumentSplitter, optional): The splitter shared across documents. Defaults to the one selected by SPLITTER.
     
     Returns:
     List[Document]: A list of all document chunks for this document that were added to the vectorstore.
     """
-    text_splitter = SemanticChunker(embeddings)
-    this_doc_chunks = []
+    if text_splitter is None:
+        text_splitter = get_text_splitter(embeddings)
+    page_texts = []
+    page_metadatas = []
 
-    for filename in filenames:
-        this_uuid = str(uuid.uuid4()) # Generating one UUID for all chunks of from a specific page in the document
-        output_buffer = BytesIO()
-        s3.download_fileobj(bucket, filename, output_buffer)
-        output_buffer.seek(0)
-        doc_texts = output_buffer.read().decode('utf-8')
-        doc_chunks = text_splitter.create_documents([doc_texts])
-        
-        head, _, _ = filename.partition("_page")
-        true_filename = head 
-        
-        doc_chunks = [x for x in doc_chunks if x.page_content]
-        
-        for doc_chunk in doc_chunks:
-            if doc_chunk:
-                doc_chunk.metadata["source"] = f"s3://{bucket}/{true_filename}"
-                doc_chunk.metadata["doc_id"] = this_uuid
-                
-            else:
-                logger.warning(f"Empty chunk for {filename}")
-        
-        s3.delete_object(Bucket=bucket, Key=filename)
+    for _, page_text in pages:
+        page_texts.append(page_text)
         
-        
-        this_doc_chunks.extend(doc_chunks)
+        page_metadatas.append({
+            "source": source,
+            "doc_id": str(uuid.uuid4()) # Generating one UUID for all chunks of from a specific page in the document
+        })
+
+    # Chunk all pages in one call so the semantic splitter embeds their sentences together
+    doc_chunks = text_splitter.create_documents(page_texts, metadatas=page_metadatas)
+    this_doc_chunks = [x for x in doc_chunks if x.page_content]
        
     return this_doc_chunks
                 
@@ -194,44 +288,80 @@ def process_documents(
     embeddings (BedrockEmbeddings): The embeddings instance.
     record_manager (SQLRecordManager): Manages list of documents in the vectorstore for indexing.
     """
+    cached_embeddings = get_cached_embeddings(embeddings)
+    text_splitter = get_text_splitter(cached_embeddings)
+    # Only list the 'documents' folder so S3 filters out every other key under the topic
+    documents_prefix = f"{topic}/documents/"
     paginator = s3.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket, Prefix=f"{topic}/")
+    page_iterator = paginator.paginate(
+        Bucket=bucket,
+        Prefix=documents_prefix,
+        PaginationConfig={'PageSize': 1000}
+    )
+    etags = {}
     all_doc_chunks = []
     
     for page in page_iterator:
         if "Contents" not in page:
             continue  # Skip pages without any content (e.g., if the bucket is empty)
         for file in page['Contents']:
-            filename = file['Key']
-            
-            if filename.split('/')[-2] == "documents": # Ensures that only files in the 'documents' folder are processed
-                    this_doc_chunks = add_document(
-                        bucket=bucket,
-                        topic=topic,
-                        filename=os.path.basename(filename),
-                        vectorstore=vectorstore,
-                        embeddings=embeddings
-                    )
-
-                    all_doc_chunks.extend(this_doc_chunks)
+            etags[file['Key'][len(documents_prefix):]] = file['ETag']
+
+    # Skip documents whose content and ingest settings have not changed since they were last indexed
+    sources = {filename: get_source(topic, filename) for filename in etags}
+    versions = {filename: f"{etag}|{INGEST_FINGERPRINT}" for filename, etag in etags.items()}
+    create_etag_table(vectorstore._engine)
+    if HALFVEC_DIMENSIONS:
+        create_halfvec_index(vectorstore)
+    stored_versions = get_etags(vectorstore._engine, list(sources.values()))
+    filenames = [filename for filename in etags if stored_versions.get(sources[filename]) != versions[filename]]
+    unchanged_sources = [sources[filename] for filename in etags if stored_versions.get(sources[filename]) == versions[filename]]
+    if unchanged_sources:
+        logger.info(f"Skipping {len(unchanged_sources)} unchanged documents")
+
+    # Documents are extracted one at a time; the function has less than one vCPU and
+    # PyMuPDF is neither thread-safe nor GIL-free, so parallel extraction gains nothing
+    for filename in filenames:
+        this_doc_pages = store_doc_texts(
+            bucket=bucket,
+            topic=topic,
+            filename=filename,
+            output_bucket=EMBEDDING_BUCKET_NAME
+        )
+        this_doc_chunks = store_doc_chunks(
+            source=sources[filename],
+            pages=this_doc_pages,
+            vectorstore=vectorstore,
+            embeddings=cached_embeddings,
+            text_splitter=text_splitter
+        )
+
+        all_doc_chunks.extend(this_doc_chunks)
     
     if all_doc_chunks:  # Check if there are any documents to index
-        idx = index(
+        idx = bulk_index(
             all_doc_chunks, 
             record_manager, 
             vectorstore, 
-            cleanup="full",
-            source_id_key="source"
+            cached_embeddings,
+            source_id_key="source",
+            keep_sources=unchanged_sources
         )
         
         logger.info(f"Indexing updates: \n {idx}")
     else:
-        idx = index(
+        idx = bulk_index(
             [],
             record_manager, 
             vectorstore, 
-            cleanup="full",
-            source_id_key="source"
+            cached_embeddings,
+            source_id_key="source",
+            keep_sources=unchanged_sources
         )
-        logger.info("No documents found for indexing.")
-        
\ No newline at end of file
+        logger.info("No new documents found for indexing.")
+
+    update_etags(
+        vectorstore._engine,
+        {sources[filename]: versions[filename] for filename in etags},
+        prefix=get_source(topic, "")
+    )
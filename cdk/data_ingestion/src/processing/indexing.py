@@ -0,0 +1,369 @@
+import os, json, hashlib, logging, uuid
+from typing import Dict, List, Optional
+import numpy as np
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from langchain_postgres import PGVector
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain.indexes import SQLRecordManager
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Namespace used to derive vectorstore ids from document hashes
+NAMESPACE_UUID = uuid.UUID(int=1984)
+
+# Number of stale keys removed per cleanup round
+CLEANUP_BATCH_SIZE = 1000
+# Number of keys per record manager statement, well under the 65535 bind parameter limit
+RECORD_BATCH_SIZE = 1000
+# Table used by SQLRecordManager to store its records
+RECORD_TABLE = "upsertion_record"
+# Number of new documents embedded and copied at a time, which bounds the vectors held in memory
+EMBED_BATCH_SIZE = 256
+
+# Drop and rebuild the vector indexes around large loads when BULK_LOAD_MODE=1
+BULK_LOAD_MODE = os.environ.get("BULK_LOAD_MODE", "0") == "1"
+BULK_LOAD_THRESHOLD = int(os.environ.get("BULK_LOAD_THRESHOLD", "1000"))
+# The table is shared by every topic, so a load must also add at least this fraction of its current rows
+BULK_LOAD_RATIO = float(os.environ.get("BULK_LOAD_RATIO", "0.2"))
+BULK_LOAD_MAINTENANCE_WORK_MEM = os.environ.get("BULK_LOAD_MAINTENANCE_WORK_MEM", "2GB")
+BULK_LOAD_PARALLEL_WORKERS = int(os.environ.get("BULK_LOAD_PARALLEL_WORKERS", "4"))
+
+# Dimensions of the halfvec HNSW index on the embeddings, 0 to not build it.
+# Must match HALFVEC_DIMENSIONS of the text generation function, which queries through the index
+try:
+    HALFVEC_DIMENSIONS = int(os.environ.get("HALFVEC_DIMENSIONS", "0"))
+except ValueError as e:
+    raise ValueError(f"HALFVEC_DIMENSIONS must be an integer: {e}") from e
+if not 0 <= HALFVEC_DIMENSIONS <= 4000:
+    raise ValueError(f"HALFVEC_DIMENSIONS must be 0 (disabled) or between 1 and 4000, got {HALFVEC_DIMENSIONS}")
+
+
+def create_etag_table(engine: Engine) -> None:
+    """
+    Create the table tracking the S3 ETag of each indexed source, if it does not exist.
+
+    The stored value is opaque to these helpers; callers append a fingerprint of
+    their ingest settings to the ETag so that changing them invalidates the entry.
+
+    Args:
+    engine (Engine): The SQLAlchemy engine of the vectorstore database.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(
+            """
+            CREATE TABLE IF NOT EXISTS doc_etags (
+                source TEXT PRIMARY KEY,
+                etag TEXT NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            """
+        ))
+
+def get_etags(engine: Engine, sources: List[str]) -> Dict[str, str]:
+    """
+    Fetch the stored ETags of the given sources.
+
+    Args:
+    engine (Engine): The SQLAlchemy engine of the vectorstore database.
+    sources (List[str]): The sources to look up.
+
+    Returns:
+    Dict[str, str]: The stored ETag of each source that has one.
+    """
+    if not sources:
+        return {}
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT source, etag FROM doc_etags WHERE source = ANY(:sources);"),
+            {"sources": sources}
+        )
+        return {source: etag for source, etag in rows}
+
+def update_etags(engine: Engine, etags: Dict[str, str], prefix: str) -> None:
+    """
+    Store the ETags of the sources under a prefix, forgetting sources that no longer exist.
+
+    Args:
+    engine (Engine): The SQLAlchemy engine of the vectorstore database.
+    etags (Dict[str, str]): The ETag of every current source under the prefix.
+    prefix (str): The common prefix of the sources, e.g. the topic folder.
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            text("DELETE FROM doc_etags WHERE starts_with(source, :prefix) AND NOT (source = ANY(:sources));"),
+            {"prefix": prefix, "sources": list(etags.keys())}
+        )
+        if etags:
+            conn.execute(
+                text(
+                    """
+                    INSERT INTO doc_etags (source, etag, updated_at) VALUES (:source, :etag, now())
+                    ON CONFLICT (source) DO UPDATE SET etag = EXCLUDED.etag, updated_at = EXCLUDED.updated_at;
+                    """
+                ),
+                [{"source": source, "etag": etag} for source, etag in etags.items()]
+            )
+
+def create_halfvec_index(vectorstore: PGVector, dimensions: int = HALFVEC_DIMENSIONS) -> None:
+    """
+    Create an HNSW index on the half-precision cast of the embeddings, if it does not exist.
+
+    The embeddings stay stored at full precision; only the index holds halfvec
+    values, which roughly halves its size. Building it on an existing table blocks
+    writes until it completes, once. Afterwards copy_embeddings rebuilds it along with
+    the other vector indexes.
+
+    Args:
+    vectorstore (PGVector): The vectorstore instance.
+    dimensions (int, optional): The dimensions of the embeddings. Defaults to HALFVEC_DIMENSIONS.
+    """
+    table = vectorstore.EmbeddingStore.__tablename__
+    with vectorstore._engine.begin() as conn:
+        conn.execute(text(
+            f"""
+            CREATE INDEX IF NOT EXISTS {table}_halfvec_idx ON {table}
+            USING hnsw ((embedding::halfvec({dimensions})) halfvec_cosine_ops);
+            """
+        ))
+
+def _hash_document(doc: Document) -> str:
+    """
+    Derive a deterministic id from the content and metadata of a document.
+
+    Args:
+    doc (Document): The document to hash.
+
+    Returns:
+    str: The UUID string used as both the vectorstore id and the record manager key.
+    """
+    content = doc.page_content + json.dumps(doc.metadata, sort_keys=True)
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(NAMESPACE_UUID, content_hash))
+
+def _format_vector(vector: List[float]) -> str:
+    """
+    Format an embedding as a pgvector text literal.
+
+    pgvector stores float32 values, and NumPy prints the shortest representation
+    that round-trips at that precision, so no stored precision is lost.
+
+    Args:
+    vector (List[float]): The embedding to format.
+
+    Returns:
+    str: The embedding as a pgvector literal, e.g. "[0.1,0.2]".
+    """
+    values = np.asarray(vector, dtype=np.float32)
+    return "[" + ",".join(map(str, values)) + "]"
+
+def copy_embeddings(
+    vectorstore: PGVector,
+    ids: List[str],
+    docs: List[Document],
+    embeddings: Embeddings,
+    rebuild_indexes: bool = False,
+    batch_size: int = EMBED_BATCH_SIZE
+) -> None:
+    """
+    Embed documents and bulk load them into the vectorstore table with COPY.
+
+    Documents are embedded batch_size at a time and each batch is copied into a
+    temporary staging table before the next one is embedded, so only one batch of
+    vectors is held in memory. The staging table is merged with a single
+    INSERT ... ON CONFLICT, so re-adding an existing id updates it in place.
+    With rebuild_indexes, the HNSW/IVFFlat indexes of the table are dropped after
+    staging and recreated from their original definitions after the merge, all in
+    the same transaction. The table stays locked until the rebuild completes. Since
+    the rebuild covers the rows of every topic, it is only done when the load adds
+    at least BULK_LOAD_RATIO of the rows the table already holds.
+
+    Args:
+    vectorstore (PGVector): The vectorstore instance.
+    ids (List[str]): The ids of the documents.
+    docs (List[Document]): The documents to store.
+    embeddings (Embeddings): The embeddings instance used for the documents.
+    rebuild_indexes (bool, optional): Whether to rebuild the vector indexes around the load. Defaults to False.
+    batch_size (int, optional): The number of documents embedded and copied at a time. Defaults to EMBED_BATCH_SIZE.
+    """
+    table = vectorstore.EmbeddingStore.__tablename__
+
+    with vectorstore._make_sync_session() as session:
+        collection_id = vectorstore.get_collection(session).uuid
+
+    raw_connection = vectorstore._engine.raw_connection()
+    try:
+        with raw_connection.driver_connection.cursor() as cur:
+            cur.execute(
+                f"CREATE TEMP TABLE staging_embedding (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP;"
+            )
+            for i in range(0, len(ids), batch_size):
+                batch_docs = docs[i:i + batch_size]
+                vectors = embeddings.embed_documents([doc.page_content for doc in batch_docs])
+                with cur.copy(
+                    "COPY staging_embedding (id, collection_id, embedding, document, cmetadata) FROM STDIN"
+                ) as copy:
+                    for doc_id, doc, vector in zip(ids[i:i + batch_size], batch_docs, vectors):
+                        copy.write_row((
+                            doc_id,
+                            collection_id,
+                            _format_vector(vector),
+                            doc.page_content,
+                            json.dumps(doc.metadata)
+                        ))
+
+            index_definitions = []
+            if rebuild_indexes:
+                # Planner estimate of the row count, which avoids scanning the whole table
+                cur.execute("SELECT GREATEST(reltuples, 0) FROM pg_class WHERE oid = %s::regclass;", (table,))
+                existing_rows = cur.fetchone()[0]
+                if len(ids) < BULK_LOAD_RATIO * existing_rows:
+                    logger.info(f"Keeping indexes: {len(ids)} new rows is under {BULK_LOAD_RATIO:.0%} of {existing_rows:.0f}")
+                    rebuild_indexes = False
+            if rebuild_indexes:
+                cur.execute(
+                    """
+                    SELECT indexname, indexdef FROM pg_indexes
+                    WHERE schemaname = current_schema() AND tablename = %s
+                    AND indexdef ~* 'USING (hnsw|ivfflat)';
+                    """,
+                    (table,)
+                )
+                for index_name, index_definition in cur.fetchall():
+                    logger.info(f"Dropping index {index_name} for bulk load")
+                    cur.execute(f'DROP INDEX IF EXISTS "{index_name}";')
+                    index_definitions.append(index_definition)
+
+            cur.execute(
+                f"""
+                INSERT INTO {table} (id, collection_id, embedding, document, cmetadata)
+                SELECT id, collection_id, embedding, document, cmetadata FROM staging_embedding
+                ON CONFLICT (id) DO UPDATE
+                SET embedding = EXCLUDED.embedding,
+                    document = EXCLUDED.document,
+                    cmetadata = EXCLUDED.cmetadata;
+                """
+            )
+
+            if index_definitions:
+                cur.execute(f"SET LOCAL maintenance_work_mem = '{BULK_LOAD_MAINTENANCE_WORK_MEM}';")
+                cur.execute(f"SET LOCAL max_parallel_maintenance_workers = {BULK_LOAD_PARALLEL_WORKERS};")
+                for index_definition in index_definitions:
+                    logger.info(f"Rebuilding index: {index_definition}")
+                    cur.execute(index_definition)
+        raw_connection.commit()
+    except Exception:
+        raw_connection.rollback()
+        raise
+    finally:
+        raw_connection.close()
+
+def refresh_sources(
+    record_manager: SQLRecordManager,
+    sources: List[str]
+) -> None:
+    """
+    Mark every record of the given sources as seen now, in a single statement.
+
+    Args:
+    record_manager (SQLRecordManager): Manages list of documents in the vectorstore for indexing.
+    sources (List[str]): The group ids whose records should be kept by the next cleanup.
+    """
+    if not sources:
+        return
+    with record_manager.engine.begin() as conn:
+        conn.execute(
+            text(
+                f"""
+                UPDATE {RECORD_TABLE} SET updated_at = :updated_at
+                WHERE namespace = :namespace AND group_id = ANY(:sources);
+                """
+            ),
+            {
+                "updated_at": record_manager.get_time(),
+                "namespace": record_manager.namespace,
+                "sources": sources
+            }
+        )
+
+def bulk_index(
+    docs: List[Document],
+    record_manager: SQLRecordManager,
+    vectorstore: PGVector,
+    embeddings: Embeddings,
+    source_id_key: str = "source",
+    keep_sources: Optional[List[str]] = None
+) -> Dict[str, int]:
+    """
+    Index documents into the vectorstore with full cleanup, loading new documents in bulk.
+
+    Mirrors langchain's index(..., cleanup="full"): documents already known to the
+    record manager are skipped, new documents are embedded and copied into the
+    vectorstore in batches, and every key not seen during this run is deleted.
+    Keys of keep_sources are refreshed rather than deleted, so unchanged sources
+    that were not re-chunked stay in the vectorstore.
+
+    Args:
+    docs (List[Document]): The document chunks to index.
+    record_manager (SQLRecordManager): Manages list of documents in the vectorstore for indexing.
+    vectorstore (PGVector): The vectorstore instance.
+    embeddings (Embeddings): The embeddings instance used for the new documents.
+    source_id_key (str, optional): The metadata key identifying the source of each document. Defaults to "source".
+    keep_sources (List[str], optional): Sources whose existing documents are kept as they are. Defaults to None.
+
+    Returns:
+    Dict[str, int]: The number of documents added, updated, skipped and deleted.
+    """
+    index_start_dt = record_manager.get_time()
+
+    # Deduplicate documents within this run while keeping their order
+    docs_by_id = {}
+    for doc in docs:
+        docs_by_id.setdefault(_hash_document(doc), doc)
+
+    ids = list(docs_by_id.keys())
+    exists = []
+    for i in range(0, len(ids), RECORD_BATCH_SIZE):
+        exists.extend(record_manager.exists(ids[i:i + RECORD_BATCH_SIZE]))
+    new_ids = [doc_id for doc_id, found in zip(ids, exists) if not found]
+    new_docs = [docs_by_id[doc_id] for doc_id in new_ids]
+
+    if new_docs:
+        copy_embeddings(
+            vectorstore,
+            new_ids,
+            new_docs,
+            embeddings,
+            rebuild_indexes=BULK_LOAD_MODE and len(new_docs) >= BULK_LOAD_THRESHOLD
+        )
+
+    # Upsert records in multi-row batches, one statement and commit per batch
+    group_ids = [doc.metadata[source_id_key] for doc in docs_by_id.values()]
+    for i in range(0, len(ids), RECORD_BATCH_SIZE):
+        record_manager.update(
+            ids[i:i + RECORD_BATCH_SIZE],
+            group_ids=group_ids[i:i + RECORD_BATCH_SIZE],
+            time_at_least=index_start_dt
+        )
+
+    refresh_sources(record_manager, keep_sources or [])
+
+    num_deleted = 0
+    while True:
+        stale_ids = record_manager.list_keys(before=index_start_dt, limit=CLEANUP_BATCH_SIZE)
+        if not stale_ids:
+            break
+        vectorstore.delete(stale_ids)
+        record_manager.delete_keys(stale_ids)
+        num_deleted += len(stale_ids)
+
+    return {
+        "num_added": len(new_docs),
+        "num_updated": 0,
+        "num_skipped": len(ids) - len(new_docs),
+        "num_deleted": num_deleted,
+    }
@@ -0,0 +1,81 @@
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("EMBEDDING_BUCKET_NAME", "test-bucket")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from processing.documents import get_cached_embeddings
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Embeddings with the model id of the deployed stack, counting the texts it embeds.
+    """
+
+    model_id = "amazon.titan-embed-text-v2:0"
+
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += len(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def test_cached_embeddings_accept_model_id(tmp_path, monkeypatch):
+    monkeypatch.setattr("processing.documents.EMBEDDING_CACHE_DIR", str(tmp_path))
+    embeddings = FakeEmbeddings()
+    cached = get_cached_embeddings(embeddings)
+
+    assert cached.embed_documents(["first text", "second"]) == [[10.0, 1.0], [6.0, 1.0]]
+    assert cached.embed_documents(["first text", "second"]) == [[10.0, 1.0], [6.0, 1.0]]
+    assert embeddings.calls == 2
+
+
+def test_cached_embeddings_stay_within_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr("processing.documents.EMBEDDING_CACHE_DIR", str(tmp_path))
+    embeddings = FakeEmbeddings()
+    cached = get_cached_embeddings(embeddings, max_bytes=100)
+
+    cached.embed_documents([f"text {i}" for i in range(20)])
+
+    total = sum(path.stat().st_size for path in tmp_path.rglob("*") if path.is_file())
+    assert 0 < total <= 100
+
+
+def test_cached_embeddings_evict_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr("processing.documents.EMBEDDING_CACHE_DIR", str(tmp_path))
+    embeddings = FakeEmbeddings()
+    # Each cached vector is serialized as "[x, 1.0]", 10 bytes, so the cache holds three
+    cached = get_cached_embeddings(embeddings, max_bytes=30)
+
+    cached.embed_documents(["a", "b", "c"])
+    cached.embed_documents(["a"])  # Refreshes "a", so "b" and "c" are evicted first
+    cached.embed_documents(["text 0", "text 1"])
+    embeddings.calls = 0
+    cached.embed_documents(["a"])
+    assert embeddings.calls == 0
+    cached.embed_documents(["b"])
+    assert embeddings.calls == 1
+
+
+def test_cached_embeddings_from_concurrent_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr("processing.documents.EMBEDDING_CACHE_DIR", str(tmp_path))
+    embeddings = FakeEmbeddings()
+    cached = get_cached_embeddings(embeddings, max_bytes=500)
+    batches = [[f"text {i} {j}" for j in range(20)] for i in range(16)]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(cached.embed_documents, batches))
+
+    store = cached.document_embedding_store.store
+    total = sum(path.stat().st_size for path in tmp_path.rglob("*") if path.is_file())
+    assert store._total == total <= 500
@@ -8,6 +8,9 @@ logger = Logger()
 s3 = boto3.client('s3')
 BUCKET = os.environ["BUCKET"]
 
+# Maximum number of keys accepted by a single DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
 @logger.inject_lambda_context
 def lambda_handler(event, context):
     query_params = event.get("queryStringParameters", {})
@@ -55,12 +58,13 @@ def lambda_handler(event, context):
                 break
 
         if objects_to_delete:
-            # Delete all objects in the topic directory
-            delete_response = s3.delete_objects(
-                Bucket=BUCKET,
-                Delete={'Objects': objects_to_delete}
-            )
-            logger.info(f"Deleted objects: {delete_response}")
+            # Delete all objects in the topic directory, at most 1000 keys per request
+            for i in range(0, len(objects_to_delete), DELETE_BATCH_SIZE):
+                delete_response = s3.delete_objects(
+                    Bucket=BUCKET,
+                    Delete={'Objects': objects_to_delete[i:i + DELETE_BATCH_SIZE], 'Quiet': True}
+                )
+                logger.info(f"Deleted objects: {delete_response}")
             return {
                 'statusCode': 200,
                 "headers": {
@@ -0,0 +1,35 @@
+import os
+from typing import Any
+
+import sqlalchemy
+from pgvector.sqlalchemy import HALFVEC
+from langchain_postgres import PGVector
+from langchain_postgres.vectorstores import DistanceStrategy
+
+# Dimensions of the halfvec HNSW index built by data ingestion, 0 when the index is not used.
+# Must match HALFVEC_DIMENSIONS of the data ingestion function
+try:
+    HALFVEC_DIMENSIONS = int(os.environ.get("HALFVEC_DIMENSIONS", "0"))
+except ValueError as e:
+    raise ValueError(f"HALFVEC_DIMENSIONS must be an integer: {e}") from e
+if not 0 <= HALFVEC_DIMENSIONS <= 4000:
+    raise ValueError(f"HALFVEC_DIMENSIONS must be 0 (disabled) or between 1 and 4000, got {HALFVEC_DIMENSIONS}")
+
+
+class HalfvecPGVector(PGVector):
+    """
+    PGVector whose cosine searches order by the halfvec cast of the embeddings.
+
+    The expression matches the halfvec HNSW index, so the planner can use that
+    index instead of the full-precision one. Other distance strategies, and
+    searches with HALFVEC_DIMENSIONS=0, are left to PGVector.
+    """
+
+    @property
+    def distance_strategy(self) -> Any:
+        if not HALFVEC_DIMENSIONS or self._distance_strategy != DistanceStrategy.COSINE:
+            return super().distance_strategy
+
+        halfvec_type = HALFVEC(HALFVEC_DIMENSIONS)
+        embedding = sqlalchemy.cast(self.EmbeddingStore.embedding, halfvec_type)
+        return lambda query: embedding.cosine_distance(sqlalchemy.cast(query, halfvec_type))
@@ -5,6 +5,8 @@ import psycopg2
 from langchain_aws import BedrockEmbeddings
 from langchain_postgres import PGVector
 
+from helpers.query_cache import CachedPGVector
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -39,7 +41,7 @@ def get_vectorstore(
         )
 
         logger.info("Initializing the VectorStore")
-        vectorstore = PGVector(
+        vectorstore = CachedPGVector(
             embeddings=embeddings,
             collection_name=collection_name,
             connection=connection_string,
@@ -0,0 +1,124 @@
+import time, logging, threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+from langchain_core.documents import Document
+
+from helpers.halfvec import HalfvecPGVector
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Minimum cosine similarity between two queries for them to share results
+SIMILARITY_THRESHOLD = 0.97
+# Maximum number of cached queries kept per namespace
+MAX_ENTRIES = 256
+# Seconds before a cached result expires, so newly ingested documents become visible
+TTL_SECONDS = 300
+
+
+class SemanticQueryCache:
+    """
+    In-memory cache of similarity search results keyed by query embedding.
+
+    A lookup returns the results of a previous query whose embedding has a cosine
+    similarity of at least the threshold with the new one. Entries are kept per
+    namespace, so results are never shared across topics.
+    """
+
+    def __init__(
+        self,
+        threshold: float = SIMILARITY_THRESHOLD,
+        max_entries: int = MAX_ENTRIES,
+        ttl_seconds: float = TTL_SECONDS
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[Any, OrderedDict] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, namespace: Any, embedding: List[float]) -> Optional[List[Document]]:
+        """
+        Return the cached results of the most similar past query, if similar enough.
+
+        Args:
+        namespace (Any): The namespace to search, e.g. the collection and search parameters.
+        embedding (List[float]): The embedding of the query.
+
+        Returns:
+        Optional[List[Document]]: The cached documents, or None on a miss.
+        """
+        with self._lock:
+            entries = self._entries.get(namespace)
+            if not entries:
+                return None
+
+            now = time.monotonic()
+            for key in [key for key, (_, _, created) in entries.items() if now - created > self.ttl_seconds]:
+                del entries[key]
+            if not entries:
+                return None
+
+            keys = list(entries.keys())
+            matrix = np.stack([entries[key][0] for key in keys])
+            similarities = matrix @ _normalize(embedding)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+
+            entries.move_to_end(keys[best])
+            return list(entries[keys[best]][1])
+
+    def add(self, namespace: Any, embedding: List[float], docs: List[Document]) -> None:
+        """
+        Cache the results of a query, evicting the least recently used entry when full.
+
+        Args:
+        namespace (Any): The namespace of the query.
+        embedding (List[float]): The embedding of the query.
+        docs (List[Document]): The documents returned for the query.
+        """
+        with self._lock:
+            entries = self._entries.setdefault(namespace, OrderedDict())
+            entries[tuple(embedding)] = (_normalize(embedding), list(docs), time.monotonic())
+            entries.move_to_end(tuple(embedding))
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# Shared by every vectorstore in this container, so warm invocations reuse it
+query_cache = SemanticQueryCache()
+
+
+class CachedPGVector(HalfvecPGVector):
+    """
+    PGVector whose similarity searches are served from the semantic query cache when possible.
+    """
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        **kwargs: Any
+    ) -> List[Document]:
+        embedding = self.embeddings.embed_query(query)
+        namespace: Tuple = (self.collection_name, k, repr(filter), repr(sorted(kwargs.items())))
+
+        docs = query_cache.lookup(namespace, embedding)
+        if docs is not None:
+            logger.info(f"Semantic cache hit for collection {self.collection_name}")
+            return docs
+
+        docs = self.similarity_search_by_vector(embedding, k=k, filter=filter, **kwargs)
+        query_cache.add(namespace, embedding, docs)
+        return docs